@@ -1,78 +1,368 @@
 import asyncio
-import json
+import msgspec
 import websockets
 import os
-from typing import Dict, Set, Any
+import socket
+import sys
+from collections import defaultdict
+from typing import Dict, Set, Any, List, Optional, Sequence, Union
 
 # --- Constants and Global State ---
 
-# A dictionary mapping WebSocket connections to client information.
-# CLIENTS[websocket] = {"user_id": str, "room_name": str, "whitelist": set | list}
-CLIENTS: Dict[websockets.WebSocketServerProtocol, Dict[str, Any]] = {}
-
 # A helper dictionary to quickly find a client's connection by their user_id.
 # USER_ID_MAP[user_id] = websocket
 USER_ID_MAP: Dict[str, websockets.WebSocketServerProtocol] = {}
 
+# An index of the registered connections in each room, so room-wide
+# operations only touch that room's members.
+# ROOMS[room_name] = {websocket, ...}
+ROOMS: Dict[str, Set[websockets.WebSocketServerProtocol]] = defaultdict(set)
+
 # The maximum allowed size for an incoming WebSocket message in bytes (1MB).
 MAX_MESSAGE_SIZE = 1_048_576
 
-async def send_json(websocket: websockets.WebSocketServerProtocol, data: Dict[str, Any]):
+# The maximum number of outgoing messages held for a client, counting both
+# those waiting in its queue and the batch its writer task is sending.
+# Relayed payloads are copied out of the sender's frame before being queued,
+# so each held message costs about its own payload size (at most
+# MAX_MESSAGE_SIZE) rather than the whole frame it arrived in. Messages that
+# would go over the limit are rejected back to their sender.
+OUT_QUEUE_SIZE = 64
+
+# How many messages a client's handler processes back to back before yielding
+# to the event loop. Frames that arrive together are handled without ever
+# suspending, so without this a burst from one sender could fill a
+# recipient's queue before its writer task gets a chance to run.
+MESSAGES_PER_YIELD = 8
+
+# How long, in seconds, writing the frames queued for a client may take before
+# the client is considered stalled and disconnected.
+SEND_TIMEOUT = 5.0
+
+# The close reason sent, with code 1013 (try again later), to clients that
+# have stalled while a frame was being sent to them.
+SLOW_CLIENT_REASON = "Client is not reading messages fast enough."
+
+# TCP_CORK is only available on Linux; elsewhere writes rely on TCP_NODELAY alone.
+TCP_CORK = getattr(socket, "TCP_CORK", None)
+
+# --- Client State ---
+
+class ClientState:
+    """
+    The server-side state of a registered client.
+
+    It is attached to the client's connection as `websocket.client_state`, so
+    handlers reach it with a single attribute load instead of a dict lookup.
+
+    While `wildcard` is True the client accepts messages from everyone in the
+    room and `whitelist` is empty. The outgoing queue is created with the
+    state; the writer task draining it is started once the client is
+    registered.
+
+    Using __slots__ keeps each instance free of a per-object __dict__, which
+    adds up on servers with many connections.
     """
-    Serializes a dictionary to a JSON string and sends it to a client.
+    __slots__ = ("user_id", "room_name", "wildcard", "whitelist", "out_queue", "pending", "writer_task")
+
+    def __init__(self, user_id: str, room_name: str, wildcard: bool, whitelist: Set[str]):
+        self.user_id = user_id
+        self.room_name = room_name
+        self.wildcard = wildcard
+        self.whitelist = whitelist
+        self.out_queue: asyncio.Queue = asyncio.Queue()
+        # Messages queued or being sent, at most OUT_QUEUE_SIZE.
+        self.pending = 0
+        self.writer_task: Optional[asyncio.Task] = None
+
+# The subprotocol clients can request to exchange MessagePack binary frames
+# instead of JSON. Clients that don't request it keep using JSON.
+MSGPACK_SUBPROTOCOL = "msgpack"
+
+# --- Message Schemas ---
+# Each client message type is a tagged struct; the tag is read from the
+# message's "type" field. Decoding into these types validates the message in
+# the same pass, so anything that doesn't match a schema fails to decode.
+#
+# Message structs are created for every frame but can never form reference
+# cycles, so they opt out of garbage collector tracking (gc=False).
+
+class Register(msgspec.Struct, tag="register", gc=False):
+    """Sent once, immediately after connecting."""
+    user_id: str
+    whitelist: List[str]
+
+class Message(msgspec.Struct, tag="message", gc=False):
+    """
+    Sends a payload to another user.
+
+    The payload is only relayed, never inspected, so it is kept as the raw
+    encoded bytes instead of being decoded into Python objects.
+    """
+    recipient_id: str
+    payload: msgspec.Raw
+
+class WhitelistAdd(msgspec.Struct, tag="whitelist_add", gc=False):
+    """Adds a user to the sender's whitelist."""
+    user_id: str
+
+class WhitelistRemove(msgspec.Struct, tag="whitelist_remove", gc=False):
+    """Removes a user from the sender's whitelist."""
+    user_id: str
+
+class WhitelistToggle(msgspec.Struct, tag="whitelist_toggle_wildcard", gc=False):
+    """Turns the sender's wildcard whitelist on or off."""
+    enabled: bool
+
+ClientMessage = Union[Register, Message, WhitelistAdd, WhitelistRemove, WhitelistToggle]
+
+# Server messages are tagged structs too, so their field names and "type"
+# values are encoded from msgspec's cached representation rather than a
+# freshly built dict on every send.
+
+class IncomingMessage(msgspec.Struct, tag="incoming_message", gc=False):
+    """Relays a payload from another user."""
+    sender_id: str
+    payload: Any
+
+class WhitelistUpdated(msgspec.Struct, tag="whitelist_updated", gc=False):
+    """Confirms a whitelist command was processed."""
+    message: str
+    current_whitelist: List[str]
+
+class Error(msgspec.Struct, tag="error", gc=False):
+    """Reports that an action failed."""
+    message: str
+
+ServerMessage = Union[IncomingMessage, WhitelistUpdated, Error]
+
+# The delivery failure text. It is intentionally generic to prevent probing
+# for user presence; only the recipient is interpolated.
+DELIVERY_FAILURE_TEMPLATE = "Could not deliver message to '{}'. The user may be offline or has not whitelisted you."
+
+# Reusable encoders and decoders for each wire format, shared by every
+# connection.
+_json_encoder = msgspec.json.Encoder()
+_json_decoder = msgspec.json.Decoder(ClientMessage)
+_msgpack_encoder = msgspec.msgpack.Encoder()
+_msgpack_decoder = msgspec.msgpack.Decoder(ClientMessage)
+
+# The bytes a valid frame can start with in each wire format: every client
+# message is an object, which in JSON may be preceded by whitespace, and in
+# MessagePack has a fixmap, map16 or map32 header. Frames starting with
+# anything else are dropped before reaching a decoder.
+_JSON_FRAME_STARTS = frozenset(b"{ \t\n\r")
+_MSGPACK_FRAME_STARTS = frozenset([*range(0x80, 0x90), 0xde, 0xdf])
+
+# Untyped decoders for converting a raw payload between wire formats.
+_json_payload_decoder = msgspec.json.Decoder()
+_msgpack_payload_decoder = msgspec.msgpack.Decoder()
+
+def select_subprotocol(connection: websockets.WebSocketServerProtocol, subprotocols: Sequence[str]) -> Optional[str]:
+    """
+    Picks the wire format for a new connection during the handshake.
+
+    Clients offering the msgpack subprotocol get MessagePack binary frames,
+    everyone else falls back to JSON instead of being rejected.
 
     Args:
-        websocket: The WebSocket connection to send the message to.
-        data: The dictionary to serialize and send.
+        connection: The connection being negotiated.
+        subprotocols: The subprotocols offered by the client.
+
+    Returns:
+        The selected subprotocol, or None to continue with JSON.
+    """
+    if MSGPACK_SUBPROTOCOL in subprotocols:
+        return MSGPACK_SUBPROTOCOL
+    return None
+
+def decode_message(websocket: websockets.WebSocketServerProtocol, message: bytes) -> ClientMessage:
+    """
+    Deserializes and validates an incoming frame using the connection's wire format.
+
+    This acts as a security checkpoint, ensuring that incoming data conforms
+    to one of the message schemas before any processing occurs.
+
+    Args:
+        websocket: The WebSocket connection the frame was received on.
+        message: The raw frame data, received without UTF-8 decoding.
+
+    Returns:
+        The decoded message struct.
+
+    Raises:
+        msgspec.DecodeError: If the frame is malformed or doesn't match a
+            message schema.
+        UnicodeDecodeError: If a string in the frame isn't valid UTF-8.
+    """
+    if websocket.subprotocol == MSGPACK_SUBPROTOCOL:
+        return _msgpack_decoder.decode(message)
+    return _json_decoder.decode(message)
+
+def convert_payload(sender_ws: websockets.WebSocketServerProtocol, recipient_ws: websockets.WebSocketServerProtocol,
+                    payload: msgspec.Raw) -> Optional[msgspec.Raw]:
+    """
+    Prepares a raw message payload to be relayed to its recipient.
+
+    If both clients use the same wire format, the raw bytes are forwarded
+    untouched, only copied out of the sender's frame so that a queued message
+    doesn't keep the whole frame alive. Otherwise the payload is converted to
+    the recipient's format here, so a payload that can't be represented in it
+    is caught before it reaches the recipient's writer task.
+
+    msgspec doesn't check UTF-8 inside a raw span, and JSON payloads are
+    relayed in text frames, so JSON payloads are always checked for valid
+    UTF-8 before being forwarded.
+
+    Args:
+        sender_ws: The WebSocket connection the payload was received on.
+        recipient_ws: The WebSocket connection it will be sent on.
+        payload: The raw payload, still in the sender's wire format.
+
+    Returns:
+        The raw payload in the recipient's wire format, or None if it can't
+        be converted (e.g. a MessagePack extension type sent to a JSON client,
+        a JSON number too large for MessagePack, or a JSON payload that isn't
+        valid UTF-8).
     """
     try:
-        await websocket.send(json.dumps(data))
-    except websockets.exceptions.ConnectionClosed:
+        if sender_ws.subprotocol == MSGPACK_SUBPROTOCOL:
+            if recipient_ws.subprotocol == MSGPACK_SUBPROTOCOL:
+                return payload.copy()
+            return msgspec.Raw(_json_encoder.encode(_msgpack_payload_decoder.decode(payload)))
+        if recipient_ws.subprotocol != MSGPACK_SUBPROTOCOL:
+            str(payload, "utf-8")
+            return payload.copy()
+        return msgspec.Raw(_msgpack_encoder.encode(_json_payload_decoder.decode(payload)))
+    except (TypeError, OverflowError, UnicodeDecodeError, msgspec.DecodeError):
+        return None
+
+def encode_message(websocket: websockets.WebSocketServerProtocol, data: Union[ServerMessage, List[ServerMessage]]) -> bytes:
+    """
+    Serializes outgoing data using the connection's wire format.
+
+    Args:
+        websocket: The WebSocket connection the data will be sent on.
+        data: The message, or list of messages, to serialize.
+
+    Returns:
+        The encoded frame data: MessagePack for clients on the msgpack
+        subprotocol, and UTF-8 JSON for everyone else.
+    """
+    if websocket.subprotocol == MSGPACK_SUBPROTOCOL:
+        return _msgpack_encoder.encode(data)
+    return _json_encoder.encode(data)
+
+def set_tcp_option(sock: Optional[socket.socket], option: Optional[int], value: int):
+    """
+    Sets a TCP-level option on a client's socket.
+
+    Does nothing if the socket or option is unavailable, or if the socket
+    has already been closed.
+
+    Args:
+        sock: The client's underlying socket, if any.
+        option: The TCP option to set, e.g. socket.TCP_NODELAY.
+        value: The value to set the option to.
+    """
+    if sock is None or option is None:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, option, value)
+    except OSError:
         pass
 
-def validate_schema(data: Dict[str, Any]) -> bool:
+def send_json(websocket: websockets.WebSocketServerProtocol, data: ServerMessage) -> bool:
     """
-    Validates the structure and types of an incoming message dictionary.
+    Queues a message to be sent to a client by its writer task.
 
-    This function acts as a security checkpoint, ensuring that incoming data
-    conforms to the expected format before any processing occurs.
+    This never waits on the network, so a slow recipient can't hold up the
+    handler that produced the message. If the client already has
+    OUT_QUEUE_SIZE messages queued or being sent, the message is not queued;
+    the client itself is only disconnected by its writer task once a send
+    actually stalls.
 
     Args:
-        data: The deserialized JSON data from a client message.
+        websocket: The WebSocket connection to send the message to.
+        data: The server message to serialize and send.
 
     Returns:
-        True if the data is valid, False otherwise.
+        True if the message was queued, False if the client's limit was reached.
     """
-    msg_type = data.get("type")
-    if not isinstance(msg_type, str):
+    state = websocket.client_state
+    if state.pending >= OUT_QUEUE_SIZE:
         return False
+    state.pending += 1
+    state.out_queue.put_nowait(data)
+    return True
 
-    schema = {
-        "register": {"user_id": str, "whitelist": list},
-        "message": {"recipient_id": str, "payload": object},
-        "whitelist_add": {"user_id": str},
-        "whitelist_remove": {"user_id": str},
-        "whitelist_toggle_wildcard": {"enabled": bool},
-    }
+async def _send_frames(websocket: websockets.WebSocketServerProtocol, frames: List[bytes], text: bool):
+    """
+    Sends already encoded frames to a client, in order.
 
-    if msg_type not in schema:
-        return False  # Unknown message type
+    Args:
+        websocket: The WebSocket connection to write to.
+        frames: The encoded frames.
+        text: Whether to send them as text frames rather than binary ones.
+    """
+    for frame in frames:
+        await websocket.send(frame, text=text)
 
-    required_fields = schema[msg_type]
-    for field, expected_type in required_fields.items():
-        if field not in data:
-            return False
-        if expected_type is not object and not isinstance(data.get(field), expected_type):
-            return False
+async def _writer_loop(websocket: websockets.WebSocketServerProtocol, state: ClientState):
+    """
+    Sends queued messages to a client until the connection closes.
 
-    return True
+    Every message already waiting in the queue is written in one go. Clients
+    on the msgpack subprotocol get them coalesced into a single frame: one
+    pending message is sent as-is, several are sent together as an array of
+    messages. JSON clients always get one message object per frame, which is
+    what existing clients expect. On Linux the socket is corked while the
+    frames are written so they leave in as few TCP segments as possible.
 
+    Messages taken from the queue still count against the client's
+    OUT_QUEUE_SIZE limit until they have been sent. If the frames take longer
+    than SEND_TIMEOUT to send, the client has stalled and is disconnected.
+
+    Args:
+        websocket: The WebSocket connection to write to.
+        state: The client's state, holding its outgoing message queue.
+    """
+    queue = state.out_queue
+    sock = websocket.transport.get_extra_info("socket")
+    # JSON is sent in text frames straight from the encoder's UTF-8 bytes,
+    # without a round trip through str.
+    msgpack = websocket.subprotocol == MSGPACK_SUBPROTOCOL
+    text = not msgpack
+    while True:
+        batch = [await queue.get()]
+        while True:
+            try:
+                batch.append(queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+        if msgpack and len(batch) > 1:
+            frames = [encode_message(websocket, batch)]
+        else:
+            frames = [encode_message(websocket, data) for data in batch]
+
+        set_tcp_option(sock, TCP_CORK, 1)
+        try:
+            await asyncio.wait_for(_send_frames(websocket, frames, text), timeout=SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            await websocket.close(1013, SLOW_CLIENT_REASON)
+            return
+        except websockets.exceptions.ConnectionClosed:
+            return
+        finally:
+            set_tcp_option(sock, TCP_CORK, 0)
+        state.pending -= len(batch)
 
 async def register_client(websocket: websockets.WebSocketServerProtocol, room_name: str) -> bool:
     """
     Handles the initial registration and validation of a new client.
 
-    A client has 10 seconds to send a valid 'register' message. If registration is successful, the client's state is stored in the global dictionaries.
+    A client has 10 seconds to send a valid 'register' message. If registration is successful, the client's state is attached to its connection and it is added to USER_ID_MAP and ROOMS.
 
     Args:
         websocket: The new WebSocket connection.
@@ -82,31 +372,34 @@ async def register_client(websocket: websockets.WebSocketServerProtocol, room_na
         True if registration was successful, False otherwise.
     """
     try:
-        message = await asyncio.wait_for(websocket.recv(), timeout=10.0)
-        data = json.loads(message)
+        message = await asyncio.wait_for(websocket.recv(decode=False), timeout=10.0)
+        try:
+            data = decode_message(websocket, message)
+        except msgspec.ValidationError:
+            # Well-formed but not matching a schema; rejected below.
+            data = None
 
-        if validate_schema(data) and data.get("type") == "register":
-            user_id = data["user_id"]
-            whitelist = data["whitelist"]
+        if isinstance(data, Register):
+            user_id = data.user_id
+            whitelist = data.whitelist
 
             if not user_id or user_id in USER_ID_MAP:
                 await websocket.close(1008, "User ID is invalid or already in use.")
                 return False
 
-            client_info = {
-                "user_id": user_id,
-                "room_name": room_name,
-                "whitelist": ["*"] if whitelist == ["*"] else set(whitelist)
-            }
-            CLIENTS[websocket] = client_info
+            wildcard = whitelist == ["*"]
+            client_state = ClientState(user_id, room_name, wildcard, set() if wildcard else set(whitelist))
+            client_state.writer_task = asyncio.create_task(_writer_loop(websocket, client_state))
+            websocket.client_state = client_state
             USER_ID_MAP[user_id] = websocket
+            ROOMS[room_name].add(websocket)
             print(f"Client '{user_id}' registered in room '{room_name}'.")
             return True
         else:
             await websocket.close(1002, "Protocol error: First message must be a valid 'register' type.")
             return False
 
-    except (asyncio.TimeoutError, json.JSONDecodeError, websockets.exceptions.ConnectionClosed):
+    except (asyncio.TimeoutError, msgspec.DecodeError, UnicodeDecodeError, websockets.exceptions.ConnectionClosed):
         return False
 
 async def unregister_client(websocket: websockets.WebSocketServerProtocol):
@@ -116,121 +409,115 @@ async def unregister_client(websocket: websockets.WebSocketServerProtocol):
     Args:
         websocket: The WebSocket connection that has been closed.
     """
-    client_info = CLIENTS.pop(websocket, None)
-    if client_info and "user_id" in client_info:
-        user_id = client_info["user_id"]
+    client_state = getattr(websocket, "client_state", None)
+    if client_state is not None:
+        if client_state.writer_task is not None:
+            client_state.writer_task.cancel()
+        user_id = client_state.user_id
         USER_ID_MAP.pop(user_id, None)
+
+        room_members = ROOMS.get(client_state.room_name)
+        if room_members is not None:
+            room_members.discard(websocket)
+            if not room_members:
+                del ROOMS[client_state.room_name]
         print(f"Client '{user_id}' unregistered and cleaned up.")
 
 
-async def handle_direct_message(sender_ws: websockets.WebSocketServerProtocol, data: Dict[str, Any]):
+async def handle_direct_message(sender_ws: websockets.WebSocketServerProtocol, data: Message):
     """
     Processes and relays a direct message after performing security checks.
 
     A message is delivered only if all conditions are met:
     1. The client is online in the same room.
     2. The sender's user_id is present in the recipient's whitelist (or the recipient's whitelist is a wildcard "*").
+    3. The payload can be represented in the recipient's wire format.
+    4. The recipient's outgoing queue isn't full.
 
     Args:
         sender_ws: The WebSocket connection of the message sender.
         data: The validated message data containing recipient and payload.
     """
-    sender_info = CLIENTS[sender_ws]
-    sender_id = sender_info["user_id"]
-    recipient_id = data["recipient_id"]
-
-    # This generic message prevent probing for user presence.
-    generic_failure_msg = {
-        "type": "error",
-        "message": f"Could not deliver message to '{recipient_id}'. The user may be offline or has not whitelisted you."
-    }
+    sender = sender_ws.client_state
+    sender_id = sender.user_id
+    recipient_id = data.recipient_id
 
     recipient_ws = USER_ID_MAP.get(recipient_id)
     if not recipient_ws:
-        await send_json(sender_ws, generic_failure_msg)
+        send_json(sender_ws, Error(DELIVERY_FAILURE_TEMPLATE.format(recipient_id)))
         return
 
-    recipient_info = CLIENTS[recipient_ws]
+    recipient = recipient_ws.client_state
 
-    is_in_room = recipient_info["room_name"] == sender_info["room_name"]
-    is_whitelisted = (recipient_info["whitelist"] == ["*"] or sender_id in recipient_info["whitelist"])
+    is_in_room = recipient_ws in ROOMS.get(sender.room_name, ())
+    is_whitelisted = recipient.wildcard or sender_id in recipient.whitelist
 
     if is_in_room and is_whitelisted:
-        forward_message = {
-            "type": "incoming_message",
-            "sender_id": sender_id,
-            "payload": data["payload"]
-        }
-        await send_json(recipient_ws, forward_message)
-    else:
-        await send_json(sender_ws, generic_failure_msg)
+        payload = convert_payload(sender_ws, recipient_ws, data.payload)
+        # A full recipient queue pushes back on the sender, who gets the
+        # same generic failure, rather than disconnecting the recipient.
+        if payload is not None and send_json(recipient_ws, IncomingMessage(sender_id, payload)):
+            return
 
+    send_json(sender_ws, Error(DELIVERY_FAILURE_TEMPLATE.format(recipient_id)))
 
-async def handle_whitelist_command(websocket: websockets.WebSocketServerProtocol, data: Dict[str, Any]):
+
+async def handle_whitelist_command(websocket: websockets.WebSocketServerProtocol, data: Union[WhitelistAdd, WhitelistRemove]):
     """
     Updates a client's whitelist by adding or removing a user.
 
-    If a client with a wildcard ("*") whitelist adds a user, the whitelist
-    is automatically converted to a specific list containing only that user.
+    If a client with a wildcard ("*") whitelist adds a user, the wildcard is
+    turned off and the whitelist contains only that user. Removing a user
+    also turns the wildcard off.
 
     Args:
         websocket: The connection of the client updating their whitelist.
         data: The validated command data.
     """
-    client_info = CLIENTS[websocket]
-    user_to_modify = data["user_id"]
-    command = data["type"]
+    client_state = websocket.client_state
+    user_to_modify = data.user_id
     action_text = ""
 
-    if command == "whitelist_add":
-        if client_info["whitelist"] == ["*"]:
-            client_info["whitelist"] = {user_to_modify}
-            action_text = "converted from wildcard and added"
-        else:
-            client_info["whitelist"].add(user_to_modify)
-            action_text = "added"
+    if isinstance(data, WhitelistAdd):
+        action_text = "converted from wildcard and added" if client_state.wildcard else "added"
+        client_state.wildcard = False
+        client_state.whitelist.add(user_to_modify)
     
-    elif command == "whitelist_remove":
-        if client_info["whitelist"] == ["*"]:
-            client_info["whitelist"] = {}
-        else:
-            client_info["whitelist"].discard(user_to_modify)
+    elif isinstance(data, WhitelistRemove):
+        client_state.wildcard = False
+        client_state.whitelist.discard(user_to_modify)
         action_text = "removed"
     
-    current_list = list(client_info["whitelist"]) if isinstance(client_info["whitelist"], set) else client_info["whitelist"]
-    await send_json(websocket, {
-        "type": "whitelist_updated",
-        "message": f"User '{user_to_modify}' was {action_text}.",
-        "current_whitelist": current_list
-    })
+    current_list = ["*"] if client_state.wildcard else list(client_state.whitelist)
+    send_json(websocket, WhitelistUpdated(f"User '{user_to_modify}' was {action_text}.", current_list))
 
 
-async def handle_whitelist_toggle(websocket: websockets.WebSocketServerProtocol, data: Dict[str, Any]):
+async def handle_whitelist_toggle(websocket: websockets.WebSocketServerProtocol, data: WhitelistToggle):
     """
     Enables or disables a client's wildcard whitelist.
 
-    - Enabling sets the whitelist to ["*"], accepting messages from everyone.
-    - Disabling sets the whitelist to an empty set, accepting from no one.
+    - Enabling turns on the wildcard ("*"), accepting messages from everyone.
+    - Disabling turns it off with an empty whitelist, accepting from no one.
+
+    Either way, any specific users on the whitelist are cleared.
 
     Args:
         websocket: The client's WebSocket connection.
         data: The validated command data containing the 'enabled' boolean.
     """
-    client_info = CLIENTS[websocket]
+    client_state = websocket.client_state
     
-    if data["enabled"]:
-        client_info["whitelist"] = ["*"]
+    if data.enabled:
+        client_state.wildcard = True
+        client_state.whitelist = set()
         status_text = "enabled (accepting from all in room)"
     else:
-        client_info["whitelist"] = set()
+        client_state.wildcard = False
+        client_state.whitelist = set()
         status_text = "disabled (accepting from no one)"
 
-    current_list = client_info["whitelist"] if isinstance(client_info["whitelist"], list) else list(client_info["whitelist"])
-    await send_json(websocket, {
-        "type": "whitelist_updated",
-        "message": f"Wildcard whitelist has been {status_text}.",
-        "current_whitelist": current_list
-    })
+    current_list = ["*"] if client_state.wildcard else list(client_state.whitelist)
+    send_json(websocket, WhitelistUpdated(f"Wildcard whitelist has been {status_text}.", current_list))
 
 
 async def main_handler(websocket: websockets.WebSocketServerProtocol):
@@ -248,33 +535,66 @@ async def main_handler(websocket: websockets.WebSocketServerProtocol):
         await websocket.close(1008, "Room name must be provided in the URL path (e.g., /my-room).")
         return
 
+    # Replies shouldn't wait on Nagle's algorithm; batching is done by the
+    # writer task instead.
+    set_tcp_option(websocket.transport.get_extra_info("socket"), socket.TCP_NODELAY, 1)
+
     if not await register_client(websocket, room_name):
         return
 
-    handler_map = {
-        "message": handle_direct_message,
-        "whitelist_add": handle_whitelist_command,
-        "whitelist_remove": handle_whitelist_command,
-        "whitelist_toggle_wildcard": handle_whitelist_toggle,
-    }
+    # Bind everything the per-message loop touches to locals, so each frame
+    # pays for fast local loads instead of module and attribute lookups.
+    if websocket.subprotocol == MSGPACK_SUBPROTOCOL:
+        frame_starts = _MSGPACK_FRAME_STARTS
+        decode = _msgpack_decoder.decode
+    else:
+        frame_starts = _JSON_FRAME_STARTS
+        decode = _json_decoder.decode
+    recv = websocket.recv
+    # Frames skip the library's UTF-8 check, so invalid UTF-8 inside a string
+    # surfaces from msgspec as UnicodeDecodeError rather than DecodeError.
+    decode_errors = (msgspec.DecodeError, UnicodeDecodeError)
+    message_type, add_type, remove_type, toggle_type = Message, WhitelistAdd, WhitelistRemove, WhitelistToggle
+    direct_message_handler = handle_direct_message
+    whitelist_command_handler = handle_whitelist_command
+    whitelist_toggle_handler = handle_whitelist_toggle
+    sleep = asyncio.sleep
+    until_yield = MESSAGES_PER_YIELD
 
     try:
-        async for message in websocket:
+        while True:
+            # Frames are received as raw bytes, skipping the library's UTF-8
+            # decoding of text frames; the decoders validate the data anyway.
+            message = await recv(decode=False)
+            if not message or message[0] not in frame_starts:
+                # Cheaply reject frames that can't be a message.
+                continue
             try:
-                data = json.loads(message)
-                if not validate_schema(data):
-                    # Silently ignore messages that don't conform to the schema.
-                    # This prevents wasting resources on malformed requests.
-                    continue
-                
-                handler_func = handler_map.get(data["type"])
-                if handler_func:
-                    await handler_func(websocket, data)
-
-            except json.JSONDecodeError:
-                # Ignore messages that are not valid JSON.
+                data = decode(message)
+            except decode_errors:
+                # Silently ignore messages that can't be decoded or don't
+                # conform to a schema. This prevents wasting resources on
+                # malformed requests.
                 continue
-    
+
+            # Dispatch on the exact struct type, most frequent first.
+            # A repeated 'register' message is ignored.
+            msg_type = type(data)
+            if msg_type is message_type:
+                await direct_message_handler(websocket, data)
+            elif msg_type is add_type or msg_type is remove_type:
+                await whitelist_command_handler(websocket, data)
+            elif msg_type is toggle_type:
+                await whitelist_toggle_handler(websocket, data)
+
+            until_yield -= 1
+            if not until_yield:
+                until_yield = MESSAGES_PER_YIELD
+                await sleep(0)
+
+    except websockets.exceptions.ConnectionClosed:
+        pass
+
     finally:
         await unregister_client(websocket)
 
@@ -286,15 +606,39 @@ async def main():
     server_settings = {
         "host": "0.0.0.0",
         "port": port,
-        "max_size": MAX_MESSAGE_SIZE
+        "max_size": MAX_MESSAGE_SIZE,
+        "select_subprotocol": select_subprotocol,
+        # Messages are small, so permessage-deflate costs more CPU than it
+        # saves in bandwidth.
+        "compression": None,
     }
 
+    try:
+        # The C extension handles frame masking, the per-byte hot loop of
+        # every received frame. It ships in websockets' binary wheels.
+        from websockets import speedups  # noqa: F401
+    except ImportError:
+        print("Warning: websockets' C extension is unavailable; frames will be processed in pure Python, which is much slower.")
+
     async with websockets.serve(main_handler, **server_settings):
         print(f"WebSocket server started on port {port}.")
         await asyncio.Future()  # Run forever
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        # uvloop is a faster drop-in event loop, but isn't available on
+        # Windows, where its port winloop is used instead.
+        if sys.platform == "win32":
+            import winloop as fast_loop
+        else:
+            import uvloop as fast_loop
+    except ImportError:
+        fast_loop = None
+
+    try:
+        if fast_loop is not None:
+            fast_loop.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         print("Server shutting down.")
\ No newline at end of file